@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+""" Replay recorded bags through the particle filter without a running ROS graph.
+
+    Each bag is paired with a map YAML (in the format used by nav2_map_server) and
+    processed in its own worker process, so a batch of bags takes roughly
+    (number of bags / number of cores) times as long as a single bag.
+
+    Example:
+        bag_replay.py bags/demo-1 bags/demo-2 bags/demo-3 --map maps/gauntlet.yaml --output-dir replay_results
+
+    For every bag the output directory gets <bag name>_trajectory.csv (the pose
+    estimate after each filter update) and <bag name>_latency.csv (the time spent
+    in run_loop for each processed scan).  The bag name is the bag's directory name,
+    or, if several bags share a directory name, the part of their paths that tells
+    them apart (e.g., a/take_1 and b/take_1 become a_take_1 and b_take_1).  summary.csv collects the latency
+    statistics and trajectory length of every bag, and with --scoring-cache the fraction of particle
+    scores that the filter's scoring cache served over the bag's laser updates.
+"""
+
+import argparse
+import csv
+import math
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import yaml
+
+SUMMARY_FIELDS = ['bag', 'map', 'status', 'scans', 'updates', 'wall_time',
+                  'latency_mean', 'latency_p50', 'latency_p95', 'latency_max', 'path_length',
+                  'scoring_cache_hit_rate']
+
+def read_pgm(path):
+    """ Read a binary (P5) PGM image into a numpy array of shape (height, width) """
+    with open(path, 'rb') as f:
+        data = f.read()
+    tokens = []
+    pos = 0
+    # the header is four whitespace separated tokens: magic, width, height and maxval
+    while len(tokens) < 4:
+        while data[pos:pos+1].isspace():
+            pos += 1
+        if data[pos:pos+1] == b'#':
+            pos = data.index(b'\n', pos) + 1
+            continue
+        start = pos
+        while not data[pos:pos+1].isspace():
+            pos += 1
+        tokens.append(data[start:pos])
+    if tokens[0] != b'P5':
+        raise ValueError("{0} is not a binary PGM image".format(path))
+    (width, height, maxval) = (int(t) for t in tokens[1:])
+    dtype = np.uint8 if maxval < 256 else np.dtype('>u2')
+    pixels = np.frombuffer(data, dtype=dtype, count=width*height, offset=pos + 1)
+    return pixels.reshape(height, width).astype(float)/maxval
+
+def load_map_yaml(path):
+    """ Build a nav_msgs/OccupancyGrid from a map YAML file, following the trinary
+        interpretation used by nav2_map_server """
+    from nav_msgs.msg import OccupancyGrid
+    from geometry_msgs.msg import Pose, Point, Quaternion
+    from angle_helpers import quaternion_from_euler
+
+    with open(path) as f:
+        config = yaml.safe_load(f)
+    image = read_pgm(os.path.join(os.path.dirname(path), config['image']))
+    occupancy = image if config.get('negate', 0) else 1.0 - image
+    data = np.full(occupancy.shape, -1, dtype=np.int8)
+    data[occupancy > config['occupied_thresh']] = 100
+    data[occupancy < config['free_thresh']] = 0
+    # the first row of the image is the top of the map, but the first row of the grid is the bottom
+    data = np.flipud(data)
+
+    map_msg = OccupancyGrid()
+    map_msg.header.frame_id = 'map'
+    map_msg.info.resolution = float(config['resolution'])
+    map_msg.info.width = data.shape[1]
+    map_msg.info.height = data.shape[0]
+    (x, y, yaw) = config['origin']
+    q = quaternion_from_euler(0, 0, yaw)
+    map_msg.info.origin = Pose(position=Point(x=float(x), y=float(y), z=0.0),
+                               orientation=Quaternion(x=q[0], y=q[1], z=q[2], w=q[3]))
+    map_msg.data = data.ravel().tolist()
+    return map_msg
+
+def write_csv(path, header, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+def output_names(bags):
+    """ Choose the name that the output files of each bag start with, see the module docstring
+
+        returns: a list of names, one per bag, or None if the bags can't be told apart """
+    paths = [os.path.abspath(bag) for bag in bags]
+    basenames = [os.path.basename(path) for path in paths]
+    names = []
+    for (path, basename) in zip(paths, basenames):
+        clashing = [other for (other, other_basename) in zip(paths, basenames) if other_basename == basename]
+        if len(clashing) == 1:
+            names.append(basename)
+        else:
+            common = os.path.commonpath(clashing)
+            names.append(os.path.relpath(path, common).replace(os.sep, '_'))
+    if len(set(names)) != len(names) or '.' in names:
+        return None
+    return names
+
+def replay_bag(bag_dir, map_yaml, output_dir, name, use_scoring_cache=False):
+    """ Run the particle filter over every scan of a bag and write its trajectory and
+        latency statistics to output_dir, in files starting with name.  This runs in a
+        worker process, so ROS is initialized and shut down here.
+            use_scoring_cache: whether the filter shares laser scores between nearby particles
+
+        returns: a dictionary with the fields in SUMMARY_FIELDS """
+    import rclpy
+    import rosbag2_py
+    from rclpy.serialization import deserialize_message
+    from sensor_msgs.msg import LaserScan
+    from tf2_msgs.msg import TFMessage
+    from pf import ParticleFilter
+
+    summary = {'bag': bag_dir, 'map': map_yaml}
+    rclpy.init()
+    try:
+        pf = ParticleFilter(map_msg=load_map_yaml(map_yaml), run_thread=False)
+        # every replay starts from scratch rather than from a live robot's checkpoint
+        pf.checkpoint_path = None
+        pf.use_scoring_cache = use_scoring_cache
+        # the CPU budget is measured in wall-clock time, which would make the updates (and so the
+        # trajectory) depend on how busy the machine is rather than only on the bag
+        pf.update_scheduler.cpu_budget = None
+        tf_buffer = pf.transform_helper.tf_buffer
+        scan_topic = '/' + pf.scan_topic.lstrip('/')
+
+        reader = rosbag2_py.SequentialReader()
+        reader.open(rosbag2_py.StorageOptions(uri=bag_dir, storage_id='sqlite3'),
+                    rosbag2_py.ConverterOptions(input_serialization_format='cdr',
+                                                output_serialization_format='cdr'))
+        reader.set_filter(rosbag2_py.StorageFilter(topics=['/tf', '/tf_static', scan_topic]))
+
+        trajectory = []
+        latencies = []
+        scans = 0
+        # particles scored and scores served from the cache, summed over the laser updates
+        cache_lookups = 0
+        cache_hits = 0
+        last_pose = None
+        start = time.perf_counter()
+        while reader.has_next():
+            (topic, data, t) = reader.read_next()
+            if topic == scan_topic:
+                scans += 1
+                pf.scan_received(deserialize_message(data, LaserScan))
+            else:
+                for transform in deserialize_message(data, TFMessage).transforms:
+                    if topic == '/tf_static':
+                        tf_buffer.set_transform_static(transform, 'bag_replay')
+                    else:
+                        tf_buffer.set_transform(transform, 'bag_replay')
+            # the odometry for a scan usually arrives after the scan itself, so keep
+            # retrying the pending scan as new transforms come in
+            msg = pf.scan_to_process
+            if msg is None:
+                continue
+            loop_start = time.perf_counter()
+            pf.run_loop()
+            if pf.scan_to_process is not None:
+                continue
+            latencies.append(time.perf_counter() - loop_start)
+            if pf.robot_pose is not last_pose:
+                last_pose = pf.robot_pose
+                cache_lookups += pf.scoring_cache_lookups
+                cache_hits += pf.scoring_cache_hits
+                (x, y, theta) = pf.transform_helper.convert_pose_to_xy_and_theta(pf.robot_pose)
+                stamp = msg.header.stamp.sec + msg.header.stamp.nanosec*1e-9
+                trajectory.append((stamp, x, y, theta))
+        wall_time = time.perf_counter() - start
+        pf.destroy_node()
+    finally:
+        rclpy.shutdown()
+
+    os.makedirs(output_dir, exist_ok=True)
+    write_csv(os.path.join(output_dir, name + '_trajectory.csv'), ['stamp', 'x', 'y', 'theta'], trajectory)
+    write_csv(os.path.join(output_dir, name + '_latency.csv'), ['latency'], [(l,) for l in latencies])
+
+    poses = np.array([row[1:3] for row in trajectory]).reshape(-1, 2)
+    latencies = np.array(latencies)
+    summary.update({'status': 'ok',
+                    'scans': scans,
+                    'updates': len(trajectory),
+                    'wall_time': wall_time,
+                    'latency_mean': latencies.mean() if len(latencies) else math.nan,
+                    'latency_p50': np.percentile(latencies, 50) if len(latencies) else math.nan,
+                    'latency_p95': np.percentile(latencies, 95) if len(latencies) else math.nan,
+                    'latency_max': latencies.max() if len(latencies) else math.nan,
+                    'path_length': np.linalg.norm(np.diff(poses, axis=0), axis=1).sum(),
+                    'scoring_cache_hit_rate': cache_hits/cache_lookups if cache_lookups else math.nan})
+    return summary
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Replay bags through the particle filter in parallel")
+    parser.add_argument('bags', nargs='+', help="bag directories to replay")
+    parser.add_argument('--map', nargs='+', required=True, dest='maps',
+                        help="map YAML files, either one for all bags or one per bag")
+    parser.add_argument('--output-dir', default='replay_results',
+                        help="where to write trajectories, latencies and summary.csv")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help="number of bags to replay at the same time (default: number of cores)")
+    parser.add_argument('--scoring-cache', action='store_true',
+                        help="share laser scores between particles in the same (x, y, theta) bin")
+    args = parser.parse_args(args)
+
+    if len(args.maps) == 1:
+        maps = args.maps*len(args.bags)
+    elif len(args.maps) == len(args.bags):
+        maps = args.maps
+    else:
+        parser.error("expected one map or one map per bag, got {0} maps for {1} bags".format(len(args.maps), len(args.bags)))
+    names = output_names(args.bags)
+    if names is None:
+        parser.error("the same bag was given more than once")
+
+    summaries = []
+    # rclpy is not safe to use after a fork, so every worker starts from a fresh interpreter
+    with ProcessPoolExecutor(max_workers=args.jobs,
+                             mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = {executor.submit(replay_bag, bag, map_yaml, args.output_dir, name,
+                                   args.scoring_cache): (bag, map_yaml)
+                   for (bag, map_yaml, name) in zip(args.bags, maps, names)}
+        for future in as_completed(futures):
+            (bag, map_yaml) = futures[future]
+            try:
+                summary = future.result()
+            except Exception as e:
+                summary = {'bag': bag, 'map': map_yaml, 'status': 'failed: {0}'.format(e)}
+            print("{0}: {1}".format(bag, summary['status']))
+            summaries.append(summary)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    summaries.sort(key=lambda s: args.bags.index(s['bag']))
+    write_csv(os.path.join(args.output_dir, 'summary.csv'), SUMMARY_FIELDS,
+              [[s.get(field, '') for field in SUMMARY_FIELDS] for s in summaries])
+    return 0 if all(s['status'] == 'ok' for s in summaries) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,100 @@
+""" Reading and writing particle filter checkpoints so that a restarted filter
+    can pick up where it left off instead of re-converging from scratch.
+
+    A checkpoint is a fixed size header followed by one (x, y, theta, w) record
+    per particle, all stored as raw little endian numbers so the file can be
+    memory mapped directly with numpy. """
+
+import hashlib
+import os
+import numpy as np
+
+CHECKPOINT_MAGIC = b'PFCK'
+CHECKPOINT_VERSION = 1
+
+HEADER_DTYPE = np.dtype([('magic', 'S4'),
+                         ('version', '<u4'),
+                         ('wall_time', '<f8'),              # time.time() when the checkpoint was written
+                         ('map_fingerprint', 'S40'),        # see map_fingerprint
+                         ('n_particles', '<u4'),
+                         ('odom_xy_theta', '<f8', (3,)),    # the odometry pose of the last filter update
+                         ('map_to_odom_translation', '<f8', (3,)),
+                         ('map_to_odom_rotation', '<f8', (4,))])
+
+PARTICLE_DTYPE = np.dtype([('x', '<f8'), ('y', '<f8'), ('theta', '<f8'), ('w', '<f8')])
+
+class Checkpoint(object):
+    """ The filter state read back from a checkpoint file
+        Attributes:
+            wall_time: when the checkpoint was written (seconds since the epoch)
+            map_fingerprint: the fingerprint of the map the particles were localized in
+            particles: a structured array with fields x, y, theta and w (memory mapped, read only)
+            odom_xy_theta: the odometry pose (x, y, theta) at the last filter update
+            map_to_odom: the (translation, rotation) tuple of the map -> odom correction
+    """
+    def __init__(self, header, particles):
+        self.wall_time = float(header['wall_time'])
+        self.map_fingerprint = bytes(header['map_fingerprint'])
+        self.particles = particles
+        self.odom_xy_theta = tuple(header['odom_xy_theta'].tolist())
+        self.map_to_odom = (tuple(header['map_to_odom_translation'].tolist()),
+                            tuple(header['map_to_odom_rotation'].tolist()))
+
+def map_fingerprint(map_msg):
+    """ A hex digest identifying the geometry and contents of a nav_msgs/OccupancyGrid """
+    info = map_msg.info
+    h = hashlib.sha1()
+    h.update(np.array([info.width, info.height], dtype='<u4').tobytes())
+    h.update(np.array([info.resolution,
+                       info.origin.position.x, info.origin.position.y, info.origin.position.z,
+                       info.origin.orientation.x, info.origin.orientation.y,
+                       info.origin.orientation.z, info.origin.orientation.w], dtype='<f8').tobytes())
+    h.update(np.asarray(map_msg.data, dtype=np.int8).tobytes())
+    return h.hexdigest().encode()
+
+def write_checkpoint(path, wall_time, fingerprint, particles, odom_xy_theta, map_to_odom):
+    """ Write a checkpoint to path.  The file is written next to path and then renamed
+        over it, so a reader never sees a partially written checkpoint.
+            particles: a sequence of (x, y, theta, w) tuples
+            map_to_odom: a (translation, rotation) tuple as stored by TFHelper """
+    header = np.zeros(1, dtype=HEADER_DTYPE)
+    header['magic'] = CHECKPOINT_MAGIC
+    header['version'] = CHECKPOINT_VERSION
+    header['wall_time'] = wall_time
+    header['map_fingerprint'] = fingerprint
+    header['n_particles'] = len(particles)
+    header['odom_xy_theta'] = odom_xy_theta
+    header['map_to_odom_translation'] = map_to_odom[0]
+    header['map_to_odom_rotation'] = map_to_odom[1]
+    records = np.array(list(particles), dtype=PARTICLE_DTYPE)
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(records.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def read_checkpoint(path):
+    """ Memory map the checkpoint at path.
+
+        returns: a Checkpoint, or None if there is no usable checkpoint at path """
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return None
+    if size < HEADER_DTYPE.itemsize:
+        return None
+    header = np.memmap(path, dtype=HEADER_DTYPE, mode='r', shape=(1,))[0]
+    if header['magic'] != CHECKPOINT_MAGIC or header['version'] != CHECKPOINT_VERSION:
+        return None
+    n_particles = int(header['n_particles'])
+    if size != HEADER_DTYPE.itemsize + n_particles*PARTICLE_DTYPE.itemsize or n_particles == 0:
+        return None
+    particles = np.memmap(path, dtype=PARTICLE_DTYPE, mode='r',
+                          offset=HEADER_DTYPE.itemsize, shape=(n_particles,))
+    return Checkpoint(header, particles)
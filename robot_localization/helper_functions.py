@@ -7,6 +7,8 @@ from geometry_msgs.msg import PoseStamped, Pose, Point, Quaternion, TransformSta
 from tf2_ros.buffer import Buffer
 from tf2_ros.transform_listener import TransformListener
 from tf2_ros.transform_broadcaster import TransformBroadcaster
+from tf2_msgs.msg import TFMessage
+from rclpy.qos import QoSProfile, DurabilityPolicy
 from angle_helpers import euler_from_quaternion
 from rclpy.time import Time
 from rclpy.duration import Duration
@@ -36,6 +38,45 @@ def draw_random_sample(choices, probabilities, n):
         samples.append(deepcopy(choices[int(i)]))
     return samples
 
+def dominant_cluster(xs, ys, weights, cell_size):
+    """ Group particles into clusters and return the indices of the cluster with the most weight.
+        Particles are hashed into square grid cells of side cell_size in one pass, and cells
+        that touch (including diagonally) are merged into the same cluster.
+            xs, ys: the particle positions represented as lists or numpy arrays
+            weights: the (non-negative) particle weights
+            cell_size: the side length of a grid cell
+    """
+    # hash every particle into its grid cell
+    cells = {}
+    for i in range(len(xs)):
+        cell = (int(math.floor(xs[i]/cell_size)), int(math.floor(ys[i]/cell_size)))
+        cells.setdefault(cell, []).append(i)
+
+    # flood fill over occupied cells to find connected clusters
+    best_indices = []
+    best_weight = -1.0
+    visited = set()
+    for start in cells:
+        if start in visited:
+            continue
+        visited.add(start)
+        stack = [start]
+        indices = []
+        while stack:
+            (cx, cy) = stack.pop()
+            indices.extend(cells[(cx, cy)])
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    neighbor = (cx + dx, cy + dy)
+                    if neighbor in cells and neighbor not in visited:
+                        visited.add(neighbor)
+                        stack.append(neighbor)
+        weight = sum(weights[i] for i in indices)
+        if weight > best_weight:
+            best_weight = weight
+            best_indices = indices
+    return best_indices
+
 class TFHelper(object):
     """ TFHelper Provides functionality to convert poses between various
         forms, compare angles in a suitable way, and publish needed
@@ -47,6 +88,16 @@ class TFHelper(object):
         self.tf_broadcaster = TransformBroadcaster(node)
         self.node = node        # hold onto this for logging
         self.transform_tolerance = Duration(seconds=0.08)    # tolerance for mismatch between scan and odom timestamp
+        self.map_to_odom = None     # (translation, rotation) of the latest map -> odom correction
+        # the laser is rigidly mounted, so its yaw in the base frame is looked up once per
+        # (base_frame, laser_frame) and only looked up again when /tf_static changes.  Each entry
+        # is (tf_static_generation at lookup time, yaw) and is stale once the generation moves on.
+        self.laser_yaw_cache = {}
+        self.tf_static_generation = 0
+        # beam angles and their cos / sin keyed by the laser yaw and scan configuration
+        self.beam_tables = {}
+        node.create_subscription(TFMessage, '/tf_static', self.tf_static_received,
+                                 QoSProfile(depth=100, durability=DurabilityPolicy.TRANSIENT_LOCAL))
 
     def convert_translation_rotation_to_pose(self, translation, rotation):
         """ Convert from representation of a pose as translation and rotation
@@ -118,24 +169,27 @@ class TFHelper(object):
                                                                   z=robot_pose.orientation.z,
                                                                   w=robot_pose.orientation.w))
         odom_to_map = robot_pose_frame * PyKDL.Frame.Inverse(odom_pose_frame)
-        self.translation = odom_to_map.p
-        self.rotation = odom_to_map.M.GetQuaternion()
+        # swap in the translation and rotation together as one immutable tuple so the
+        # transform timer never pairs the translation of one update with the rotation of another
+        self.map_to_odom = ((odom_to_map.p.x(), odom_to_map.p.y(), odom_to_map.p.z()),
+                            odom_to_map.M.GetQuaternion())
 
     def send_last_map_to_odom_transform(self, map_frame, odom_frame, timestamp):
-        if (not hasattr(self, 'translation') or
-            not hasattr(self, 'rotation')):
+        map_to_odom = self.map_to_odom
+        if map_to_odom is None:
             return
+        (translation, rotation) = map_to_odom
         transform = TransformStamped()
         transform.header.stamp = timestamp.to_msg()
         transform.header.frame_id = map_frame
         transform.child_frame_id = odom_frame
-        transform.transform.translation.x = self.translation[0]
-        transform.transform.translation.y = self.translation[1]
-        transform.transform.translation.z = self.translation[2]
-        transform.transform.rotation.x = self.rotation[0]
-        transform.transform.rotation.y = self.rotation[1]
-        transform.transform.rotation.z = self.rotation[2]
-        transform.transform.rotation.w = self.rotation[3]
+        transform.transform.translation.x = translation[0]
+        transform.transform.translation.y = translation[1]
+        transform.transform.translation.z = translation[2]
+        transform.transform.rotation.x = rotation[0]
+        transform.transform.rotation.y = rotation[1]
+        transform.transform.rotation.z = rotation[2]
+        transform.transform.rotation.w = rotation[3]
         self.tf_broadcaster.sendTransform(transform)
 
     def get_matching_odom_pose(self, odom_frame, base_frame, timestamp):
@@ -158,6 +212,47 @@ class TFHelper(object):
         else:
             return (None, None)
 
+    def tf_static_received(self, msg):
+        """ A static transform was (re)published, so the laser mount may have changed.
+            The TransformListener may not have stored the new transforms yet, so store them
+            in the buffer here before invalidating the cached laser yaws. """
+        for transform in msg.transforms:
+            self.tf_buffer.set_transform_static(transform, 'tf_static_received')
+        self.tf_static_generation += 1
+
+    def get_laser_yaw(self, base_frame, laser_frame):
+        """ Return the yaw of laser_frame relative to base_frame, using the cached value
+            if the transform has already been resolved since the last /tf_static change """
+        # read the generation before the lookup, so that a /tf_static change that lands
+        # during the lookup makes this entry stale rather than caching an old yaw
+        generation = self.tf_static_generation
+        key = (base_frame, laser_frame)
+        cached = self.laser_yaw_cache.get(key)
+        if cached is None or cached[0] != generation:
+            laser_pose = stamped_transform_to_pose(
+                self.tf_buffer.lookup_transform(base_frame,
+                                                laser_frame,
+                                                Time()))
+            rot = PyKDL.Rotation.Quaternion(x=laser_pose.orientation.x,
+                                            y=laser_pose.orientation.y,
+                                            z=laser_pose.orientation.z,
+                                            w=laser_pose.orientation.w)
+            cached = (generation, rot.GetRPY()[2])
+            self.laser_yaw_cache[key] = cached
+        return cached[1]
+
+    def get_beam_table(self, msg, base_frame):
+        """ Return a tuple (theta, cos_theta, sin_theta) of numpy arrays holding the bearing
+            of each beam of the scan in the robot frame along with its cosine and sine.
+            The arrays are computed once per laser yaw and scan configuration and are shared
+            between scans, so they must not be modified. """
+        laser_yaw = self.get_laser_yaw(base_frame, msg.header.frame_id)
+        key = (laser_yaw, msg.angle_min, msg.angle_max, len(msg.ranges))
+        if key not in self.beam_tables:
+            theta = np.linspace(msg.angle_min+laser_yaw, msg.angle_max+laser_yaw, len(msg.ranges))
+            self.beam_tables[key] = (theta, np.cos(theta), np.sin(theta))
+        return self.beam_tables[key]
+
     def convert_scan_to_polar_in_robot_frame(self, msg, base_frame):
         """ Convert the scan data to a polar representation in the robot frame.
             The reason that we have to do this differently than in the warmup project
@@ -167,13 +262,5 @@ class TFHelper(object):
 
             Note: theta is in radians
         """
-        laser_pose = stamped_transform_to_pose(
-            self.tf_buffer.lookup_transform(base_frame,
-                                            msg.header.frame_id,
-                                            Time()))
-        rot = PyKDL.Rotation.Quaternion(x=laser_pose.orientation.x,
-                                        y=laser_pose.orientation.y,
-                                        z=laser_pose.orientation.z,
-                                        w=laser_pose.orientation.w)
-        laser_yaw = rot.GetRPY()[2]
-        return (msg.ranges, np.linspace(msg.angle_min+laser_yaw, msg.angle_max+laser_yaw, len(msg.ranges)))
\ No newline at end of file
+        (theta, cos_theta, sin_theta) = self.get_beam_table(msg, base_frame)
+        return (msg.ranges, theta)
@@ -1,11 +1,25 @@
 """ An implementation of an occupancy field that you can use to implement
     your particle filter """
 
-import rclpy
+from collections import namedtuple
+from queue import Queue
+from threading import Thread, Event
 from nav_msgs.srv import GetMap
+from nav_msgs.msg import OccupancyGrid
+from map_msgs.msg import OccupancyGridUpdate
+from rclpy.qos import QoSProfile, DurabilityPolicy, ReliabilityPolicy
 import numpy as np
 from sklearn.neighbors import NearestNeighbors
 
+# An immutable view of the map and its distance field.  The occupancy field
+# swaps in a whole new MapField whenever the map changes, so readers that grab
+# self.field once always see a map, grid and closest_occ that belong together.
+#   map: the last full map received (nav_msgs/OccupancyGrid), used for its info
+#   grid: the current occupancy values indexed as grid[x, y] (partial updates applied)
+#   closest_occ: the distance in meters from each grid cell to the closest obstacle
+#   occupied: the (x, y) grid coordinates of every occupied cell
+MapField = namedtuple('MapField', ['map', 'grid', 'closest_occ', 'occupied'])
+
 class OccupancyField(object):
     """ Stores an occupancy field for an input map.  An occupancy field returns
         the distance to the closest obstacle for any coordinate in the map
@@ -13,61 +27,200 @@ class OccupancyField(object):
             map: the map to localize against (nav_msgs/OccupancyGrid)
             closest_occ: the distance for each entry in the OccupancyGrid to
             the closest obstacle
+            field: the current MapField, replaced by reference whenever the
+            map changes (None until the map has been prepared)
+            ready: an Event that is set once field is available
+            status: a short description of where map preparation is at ("failed: ..." if it
+            could not be completed)
+            map_updates: queue of pending map changes handled by the update thread
     """
 
-    def __init__(self, node):
-        # grab the map from the map server
+    def __init__(self, node, map_msg=None, status_callback=None):
+        """ node: the node used for logging and for talking to the map server
+            map_msg: the map to use (nav_msgs/OccupancyGrid).  If this is omitted the map is
+                     fetched from the map server and kept up to date with map updates,
+                     otherwise the given map is used as is (e.g., when replaying bags).
+            status_callback: called with the new status each time it changes
+
+            When the map comes from the map server the constructor returns right away and
+            the map is fetched and prepared on a background thread.  A supplied map is
+            prepared before the constructor returns. """
+        self.node = node
+        self.status_callback = status_callback
+        self.field = None
+        self.ready = Event()
+        self.status = None
+        if map_msg is not None:
+            self.prepare_field(map_msg)
+            return
+
+        # changes to the map are applied on a separate thread so that neither the
+        # filter thread nor the executor stall while the distance field is rebuilt.
+        # Updates that arrive while the map is still being prepared wait in the queue.
+        self.map_updates = Queue()
+        map_qos = QoSProfile(depth=1,
+                             durability=DurabilityPolicy.TRANSIENT_LOCAL,
+                             reliability=ReliabilityPolicy.RELIABLE)
+        node.create_subscription(OccupancyGrid, 'map', self.map_updates.put, map_qos)
+        node.create_subscription(OccupancyGridUpdate, 'map_updates', self.map_updates.put, 10)
         self.cli = node.create_client(GetMap, 'map_server/map')
+        thread = Thread(target=self.map_loop, daemon=True)
+        thread.start()
+
+    def set_status(self, status, error=False):
+        self.status = status
+        if error:
+            self.node.get_logger().error(status)
+        else:
+            self.node.get_logger().info(status)
+        if self.status_callback is not None:
+            self.status_callback(status)
+
+    def prepare_field(self, map_msg):
+        """ Build the distance field for the initial map and mark the occupancy field as ready """
+        self.set_status("building occupancy field for map width: {0} height: {1}".format(map_msg.info.width, map_msg.info.height))
+        field = self.build_field(map_msg)
+        if len(field.occupied) == 0:
+            # particles are placed within the obstacles' bounding box, so there is nothing to localize against
+            raise ValueError("the map has no occupied cells")
+        self.field = field
+        self.ready.set()
+        self.set_status("ready")
+
+    def fetch_map(self):
+        """ Request the map from the map server.  This relies on the node being spun
+            by another thread to deliver the response. """
+        self.set_status("waiting for map server")
         while not self.cli.wait_for_service(timeout_sec=1.0):
-            self.get_logger().info('service not available, waiting again...')
+            self.node.get_logger().info('service not available, waiting again...')
         self.future = self.cli.call_async(GetMap.Request())
-        rclpy.spin_until_future_complete(node, self.future)
-        self.map = self.future.result().map
-        node.get_logger().info("map received width: {0} height: {1}".format(self.map.info.width, self.map.info.height))
-        # The coordinates of each grid cell in the map
-        X = np.zeros((self.map.info.width*self.map.info.height, 2))
-
-        # while we're at it let's count the number of occupied cells
-        total_occupied = 0
-        curr = 0
-        for i in range(self.map.info.width):
-            for j in range(self.map.info.height):
-                # occupancy grids are stored in row major order
-                ind = i + j*self.map.info.width
-                if self.map.data[ind] > 0:
-                    total_occupied += 1
-                X[curr, 0] = float(i)
-                X[curr, 1] = float(j)
-                curr += 1
-
-        # The coordinates of each occupied grid cell in the map
-        occupied = np.zeros((total_occupied, 2))
-        curr = 0
-        for i in range(self.map.info.width):
-            for j in range(self.map.info.height):
-                # occupancy grids are stored in row major order
-                ind = i + j*self.map.info.width
-                if self.map.data[ind] > 0:
-                    occupied[curr, 0] = float(i)
-                    occupied[curr, 1] = float(j)
-                    curr += 1
-        node.get_logger().info("building ball tree")
+        response_received = Event()
+        self.future.add_done_callback(lambda future: response_received.set())
+        response_received.wait()
+        return self.future.result().map
+
+    def map_loop(self):
+        """ Fetch and prepare the map, then keep it up to date with map updates.  If the map
+            can't be fetched or prepared the failure is reported through the status, since
+            the filter would otherwise wait for the map without saying why. """
+        try:
+            self.prepare_field(self.fetch_map())
+        except Exception as e:
+            self.set_status("failed: {0}".format(e), error=True)
+            return
+        self.process_map_updates()
+
+    @property
+    def map(self):
+        return self.field.map
+
+    @property
+    def closest_occ(self):
+        return self.field.closest_occ
+
+    @property
+    def occupied(self):
+        return self.field.occupied
+
+    @staticmethod
+    def grid_from_map(map_msg):
+        """ Convert the row major data of an OccupancyGrid into an array indexed as grid[x, y] """
+        data = np.asarray(map_msg.data, dtype=np.int8)
+        return data.reshape(map_msg.info.height, map_msg.info.width).T.copy()
+
+    def build_field(self, map_msg):
+        """ Compute the distance to the closest obstacle for every cell of map_msg """
+        grid = self.grid_from_map(map_msg)
+        occupied = np.argwhere(grid > 0).astype(float)
+        X = np.argwhere(np.ones(grid.shape, dtype=bool)).astype(float)
+        distances = self.nearest_obstacle_distances(occupied, X)
+        closest_occ = distances.reshape(grid.shape)*map_msg.info.resolution
+        return MapField(map=map_msg, grid=grid, closest_occ=closest_occ, occupied=occupied)
+
+    @staticmethod
+    def nearest_obstacle_distances(occupied, X):
+        """ Return the distance (in grid cells) from each row of X to the closest
+            row of occupied.  If there are no obstacles every distance is inf. """
+        if len(occupied) == 0:
+            return np.full(len(X), np.inf)
         # use super fast scikit learn nearest neighbor algorithm
         nbrs = NearestNeighbors(n_neighbors=1,
                                 algorithm="ball_tree").fit(occupied)
-        node.get_logger().info("finding neighbors")
         distances, indices = nbrs.kneighbors(X)
+        return distances[:, 0]
+
+    def process_map_updates(self):
+        """ Apply queued map changes one at a time.  Each change produces a new
+            MapField which is swapped in with a single assignment. """
+        while True:
+            msg = self.map_updates.get()
+            try:
+                if isinstance(msg, OccupancyGridUpdate):
+                    self.apply_partial_update(msg)
+                else:
+                    self.apply_full_map(msg)
+            except Exception as e:
+                self.node.get_logger().error("failed to apply map update: {0}".format(e))
+
+    def apply_full_map(self, map_msg):
+        """ Handle a complete map.  If the geometry of the map is unchanged only the
+            cells that differ are recomputed, otherwise the whole field is rebuilt. """
+        field = self.field
+        new_info = map_msg.info
+        old_info = field.map.info
+        same_geometry = (new_info.width == old_info.width and
+                         new_info.height == old_info.height and
+                         new_info.resolution == old_info.resolution and
+                         new_info.origin == old_info.origin)
+        if not same_geometry:
+            self.node.get_logger().info("map geometry changed, rebuilding occupancy field")
+            self.field = self.build_field(map_msg)
+            return
+        grid = self.grid_from_map(map_msg)
+        changed = np.argwhere(grid != field.grid)
+        if len(changed) == 0:
+            self.field = field._replace(map=map_msg)
+            return
+        (x0, y0) = changed.min(axis=0)
+        (x1, y1) = changed.max(axis=0) + 1
+        self.field = self.update_region(field._replace(map=map_msg), grid, x0, y0, x1, y1)
+
+    def apply_partial_update(self, msg):
+        """ Handle a map_msgs/OccupancyGridUpdate that replaces a rectangular region of the map """
+        field = self.field
+        x0 = max(msg.x, 0)
+        y0 = max(msg.y, 0)
+        x1 = min(msg.x + msg.width, field.grid.shape[0])
+        y1 = min(msg.y + msg.height, field.grid.shape[1])
+        if x0 >= x1 or y0 >= y1:
+            return
+        patch = np.asarray(msg.data, dtype=np.int8).reshape(msg.height, msg.width).T
+        grid = field.grid.copy()
+        grid[x0:x1, y0:y1] = patch[x0 - msg.x:x1 - msg.x, y0 - msg.y:y1 - msg.y]
+        self.field = self.update_region(field, grid, x0, y0, x1, y1)
+
+    def update_region(self, field, grid, x0, y0, x1, y1):
+        """ Build a new MapField for grid given that only cells in [x0, x1) x [y0, y1)
+            differ from field.grid.
+
+            A cell's distance can only change if the changed region is no farther
+            away than its current closest obstacle, since otherwise that obstacle
+            is untouched and anything added to the region is farther away.  Only
+            those cells are queried against the new set of obstacles. """
+        resolution = field.map.info.resolution
+        xs = np.arange(grid.shape[0])[:, np.newaxis]
+        ys = np.arange(grid.shape[1])[np.newaxis, :]
+        dx = np.maximum(np.maximum(x0 - xs, xs - (x1 - 1)), 0)
+        dy = np.maximum(np.maximum(y0 - ys, ys - (y1 - 1)), 0)
+        dist_to_region = np.sqrt(dx**2 + dy**2)*resolution
+        affected = dist_to_region <= field.closest_occ + 1e-9
 
-        node.get_logger().info("populating occupancy field")
-        self.closest_occ = np.zeros((self.map.info.width, self.map.info.height))
-        curr = 0
-        for i in range(self.map.info.width):
-            for j in range(self.map.info.height):
-                self.closest_occ[i, j] = \
-                    distances[curr][0]*self.map.info.resolution
-                curr += 1
-        self.occupied = occupied
-        node.get_logger().info("occupancy field ready")
+        occupied = np.argwhere(grid > 0).astype(float)
+        closest_occ = field.closest_occ.copy()
+        closest_occ[affected] = self.nearest_obstacle_distances(occupied,
+                                                                np.argwhere(affected).astype(float))*resolution
+        self.node.get_logger().info("updated occupancy field for {0} cells".format(np.count_nonzero(affected)))
+        return MapField(map=field.map, grid=grid, closest_occ=closest_occ, occupied=occupied)
 
     def get_obstacle_bounding_box(self):
         """
@@ -75,31 +228,34 @@ class OccupancyField(object):
         bounding box contains all of the obstacles in the map.  The format of
         the return value is ((x_lower, x_upper), (y_lower, y_upper))
         """
-        lower_bounds = self.occupied.min(axis=0)
-        upper_bounds = self.occupied.max(axis=0)
-        r = self.map.info.resolution
-        return ((lower_bounds[0]*r + self.map.info.origin.position.x,
-                 upper_bounds[0]*r + self.map.info.origin.position.x),
-                (lower_bounds[1]*r + self.map.info.origin.position.y,
-                 upper_bounds[1]*r + self.map.info.origin.position.y))
+        field = self.field
+        lower_bounds = field.occupied.min(axis=0)
+        upper_bounds = field.occupied.max(axis=0)
+        r = field.map.info.resolution
+        return ((lower_bounds[0]*r + field.map.info.origin.position.x,
+                 upper_bounds[0]*r + field.map.info.origin.position.x),
+                (lower_bounds[1]*r + field.map.info.origin.position.y,
+                 upper_bounds[1]*r + field.map.info.origin.position.y))
 
     def get_closest_obstacle_distance(self, x, y):
         """ Compute the closest obstacle to the specified (x,y) coordinate in
             the map.  If the (x,y) coordinate is out of the map boundaries, nan
             will be returned. """
-        x_coord = (x - self.map.info.origin.position.x)/self.map.info.resolution
-        y_coord = (y - self.map.info.origin.position.y)/self.map.info.resolution
+        field = self.field
+        info = field.map.info
+        x_coord = (x - info.origin.position.x)/info.resolution
+        y_coord = (y - info.origin.position.y)/info.resolution
         if type(x) is np.ndarray:
-            x_coord = x_coord.astype(np.int)
-            y_coord = y_coord.astype(np.int)
+            x_coord = x_coord.astype(int)
+            y_coord = y_coord.astype(int)
         else:
             x_coord = int(x_coord)
             y_coord = int(y_coord)
 
-        is_valid = (x_coord >= 0) & (y_coord >= 0) & (x_coord < self.map.info.width) & (y_coord < self.map.info.height)
+        is_valid = (x_coord >= 0) & (y_coord >= 0) & (x_coord < info.width) & (y_coord < info.height)
         if type(x) is np.ndarray:
-            distances = np.float('nan')*np.ones(x_coord.shape)
-            distances[is_valid] = self.closest_occ[x_coord[is_valid], y_coord[is_valid]]
+            distances = float('nan')*np.ones(x_coord.shape)
+            distances[is_valid] = field.closest_occ[x_coord[is_valid], y_coord[is_valid]]
             return distances
         else:
-            return self.closest_occ[x_coord, y_coord] if is_valid else float('nan')
\ No newline at end of file
+            return field.closest_occ[x_coord, y_coord] if is_valid else float('nan')
@@ -4,21 +4,35 @@
 
 import rclpy
 from threading import Thread
+from collections import deque, namedtuple
 from rclpy.time import Time
 from rclpy.node import Node
 from robot_localization import occupancy_field
-from std_msgs.msg import Header
+from std_msgs.msg import Header, String
 from sensor_msgs.msg import LaserScan
 from geometry_msgs.msg import PoseWithCovarianceStamped, PoseArray, Pose, Point, Quaternion
 from rclpy.duration import Duration
 import math
+import os
 from statistics import mode
 import time
 import numpy as np
 from occupancy_field import OccupancyField
-from helper_functions import TFHelper, draw_random_sample
-from rclpy.qos import qos_profile_sensor_data
+from helper_functions import TFHelper, draw_random_sample, dominant_cluster
+from rclpy.qos import qos_profile_sensor_data, QoSProfile, DurabilityPolicy
 from angle_helpers import quaternion_from_euler
+from checkpoint import map_fingerprint, read_checkpoint, write_checkpoint
+from update_scheduler import UpdateScheduler
+
+# An immutable copy of the filter state published by the filter thread.  Readers on
+# other threads grab self.snapshot once and use it, so they never block an update
+# and never see a cloud that is halfway through being modified.
+#   stamp: the timestamp of the scan that produced this state
+#   particles: a tuple of (x, y, theta, w) tuples
+#   robot_pose: the estimated robot pose (geometry_msgs/Pose) or None before the first update
+#   odom_xy_theta: the odometry pose (x, y, theta) of the last filter update or None
+#   map_to_odom: the (translation, rotation) map -> odom correction that goes with robot_pose or None
+FilterSnapshot = namedtuple('FilterSnapshot', ['stamp', 'particles', 'robot_pose', 'odom_xy_theta', 'map_to_odom'])
 
 class Particle(object):
     """ Represents a hypothesis (particle) of the robot's pose consisting of x,y and theta (yaw)
@@ -57,20 +71,38 @@ class ParticleFilter(Node):
             odom_frame: the name of the odometry coordinate frame (should be "odom" in most cases)
             scan_topic: the name of the scan topic to listen to (should be "scan" in most cases)
             n_particles: the number of particles in the filter
-            d_thresh: the amount of linear movement before triggering a filter update
-            a_thresh: the amount of angular movement before triggering a filter update
+            d_thresh: the nominal amount of linear movement before triggering a filter update
+            a_thresh: the nominal amount of angular movement before triggering a filter update
+            update_scheduler: decides when to propagate, weight and resample the particles (see update_scheduler.py)
+            use_scoring_cache: whether particles that fall in the same (x, y, theta) bin share one laser evaluation
+            scoring_cache_xy_resolution: the size of a scoring cache bin in x and y (meters)
+            scoring_cache_theta_resolution: the size of a scoring cache bin in theta (radians)
+            scoring_cache_lookups: the number of particles looked up in the scoring cache during the last laser update
+            scoring_cache_hits: how many of those particles reused the score of an earlier particle in the same bin
+            checkpoint_path: where the particle cloud is periodically saved so a restarted filter can resume (None disables)
+            checkpoint_period: how often (in seconds) to save the checkpoint
+            checkpoint_max_age: the oldest checkpoint (in seconds) that will be resumed from at startup
             pose_listener: a subscriber that listens for new approximate pose estimates (i.e. generated through the rviz GUI)
             particle_pub: a publisher for the particle cloud
+            pose_pub: a publisher for the estimated robot pose and its covariance
+            pose_cluster_cell_size: the grid cell size (meters) used to group particles into clusters
+            status_pub: a publisher for the startup status of the filter (latched, so late subscribers see it)
             last_scan_timestamp: this is used to keep track of the clock when using bags
             scan_to_process: the scan that our run_loop should process next
             occupancy_field: this helper class allows you to query the map for distance to closest obstacle
             transform_helper: this helps with various transform operations (abstracting away the tf2 module)
-            particle_cloud: a list of particles representing a probability distribution over robot poses
+            particle_cloud: a list of particles representing a probability distribution over robot poses.
+                            Only the filter thread touches this list.
+            snapshot: the latest FilterSnapshot published by the filter thread for other threads to read
+            initial_pose_requests: initial poses handed from the initialpose callback to the filter thread
             current_odom_xy_theta: the pose of the robot in the odometry frame when the last filter update was performed.
                                    The pose is expressed as a list [x,y,theta] (where theta is the yaw)
             thread: this thread runs your main loop
     """
-    def __init__(self):
+    def __init__(self, map_msg=None, run_thread=True):
+        """ map_msg: the map to localize against.  If omitted it is requested from the map server.
+            run_thread: whether to start the thread that runs run_loop.  Headless users (such as
+                        bag_replay.py) pass False and call run_loop themselves. """
         super().__init__('pf')
         self.base_frame = "base_footprint"   # the frame of the robot base
         self.map_frame = "map"          # the name of the map coordinate frame
@@ -81,7 +113,23 @@ class ParticleFilter(Node):
 
         self.d_thresh = 0.2             # the amount of linear movement before performing an update
         self.a_thresh = math.pi/6       # the amount of angular movement before performing an update
-
+        # scales those thresholds with how confident the filter is and keeps it within a CPU budget
+        self.update_scheduler = UpdateScheduler(self.d_thresh, self.a_thresh)
+
+        # after resampling many particles are copies of the same parent, so optionally score
+        # each (x, y, theta) bin once per scan and share the result among its particles
+        self.use_scoring_cache = False
+        self.scoring_cache_xy_resolution = 0.05
+        self.scoring_cache_theta_resolution = math.pi/90
+        self.scoring_cache_lookups = 0
+        self.scoring_cache_hits = 0
+
+        self.checkpoint_path = os.path.join(os.path.expanduser('~'), '.ros', 'pf_checkpoint.bin')
+        self.checkpoint_period = 2.0
+        self.checkpoint_max_age = 60.0
+        self.checkpoint_restore_attempted = False
+        self.last_checkpointed_snapshot = None
+        self.map_fingerprint_cache = (None, None)    # (map message, its fingerprint)
 
         #self.step = 1                   # what step/iteration of the filter are we on, increases by 1 with each resample
 
@@ -94,9 +142,17 @@ class ParticleFilter(Node):
         # publish the current particle cloud.  This enables viewing particles in rviz.
         self.particle_pub = self.create_publisher(PoseArray, "particlecloud", qos_profile_sensor_data)
 
+        # publish the estimated pose of the robot along with how uncertain it is
+        self.pose_pub = self.create_publisher(PoseWithCovarianceStamped, "pf_pose", 10)
+        self.pose_cluster_cell_size = 0.25
+
         # laser_subscriber listens for data from the lidar
         self.create_subscription(LaserScan, self.scan_topic, self.scan_received, 10)
 
+        # reports whether the filter is still waiting for its map or is ready to localize
+        self.status_pub = self.create_publisher(String, "pf_status",
+                                                QoSProfile(depth=1, durability=DurabilityPolicy.TRANSIENT_LOCAL))
+
         # this is used to keep track of the timestamps coming from bag files
         # knowing this information helps us set the timestamp of our map -> odom
         # transform correctly
@@ -105,6 +161,15 @@ class ParticleFilter(Node):
         self.scan_to_process = None
         # your particle cloud will go here
         self.particle_cloud = []
+        self.robot_pose = None
+        # covariance of (x, y, theta) of the particles around the robot pose
+        self.robot_pose_covariance = None
+        # the fraction of the particle weight in the cluster the robot pose was taken from
+        self.robot_pose_cluster_share = None
+        # the front buffer: an immutable copy of particle_cloud swapped in by reference after each update
+        self.snapshot = None
+        # the initialpose callback never touches particle_cloud, it queues the request for the filter thread
+        self.initial_pose_requests = deque(maxlen=1)
         # probability distributions for particle cloud
         self.x_distribution = []
         self.y_distribution = []
@@ -112,13 +177,19 @@ class ParticleFilter(Node):
         self.weight_distribution = []
 
         self.current_odom_xy_theta = []
-        self.occupancy_field = OccupancyField(self)
+        # the map is fetched and prepared in the background, so the node can start spinning right away
+        self.occupancy_field = OccupancyField(self, map_msg, self.publish_status)
         self.transform_helper = TFHelper(self)
 
         # we are using a thread to work around single threaded execution bottleneck
-        thread = Thread(target=self.loop_wrapper)
-        thread.start()
+        if run_thread:
+            thread = Thread(target=self.loop_wrapper)
+            thread.start()
         self.transform_update_timer = self.create_timer(0.05, self.pub_latest_transform)
+        self.checkpoint_timer = self.create_timer(self.checkpoint_period, self.save_checkpoint)
+
+    def publish_status(self, status):
+        self.status_pub.publish(String(data=status))
 
     def pub_latest_transform(self):
         """ This function takes care of sending out the map to odom transform """
@@ -142,6 +213,13 @@ class ParticleFilter(Node):
             
             You do not need to modify this function, but it is helpful to understand it.
         """
+        if not self.occupancy_field.ready.is_set():
+            # the latest scan and initial pose stay queued until the map is ready
+            return
+        if not self.checkpoint_restore_attempted:
+            self.checkpoint_restore_attempted = True
+            self.restore_checkpoint()
+        self.process_initial_pose_requests()
         if self.scan_to_process is None:
             return
         msg = self.scan_to_process
@@ -157,7 +235,8 @@ class ParticleFilter(Node):
             return
         
         # because turtlebot fram is different from NEATO frame
-        (r, theta) = self.transform_helper.convert_scan_to_polar_in_robot_frame(msg, self.base_frame)
+        r = msg.ranges
+        (theta, cos_theta, sin_theta) = self.transform_helper.get_beam_table(msg, self.base_frame)
         #print("r[0]={0}, theta[0]={1}".format(r[0], theta[0]))
         # clear the current scan so that we can process the next one
         self.scan_to_process = None
@@ -171,22 +250,43 @@ class ParticleFilter(Node):
         elif not self.particle_cloud:
             # now that we have all of the necessary transforms we can update the particle cloud
             self.initialize_particle_cloud(msg.header.stamp)
-        elif self.moved_far_enough_to_update(new_odom_xy_theta):
-            # we have moved far enough to do an update!
-            print(len(self.particle_cloud))
-            self.update_particles_with_odom()    # update based on odometry
-            #self.publish_particles(msg.header.stamp)
-            self.update_particles_with_laser(r, theta)   # update based on laser scan
-            self.update_robot_pose()                # update robot's pose based on particles
-            self.resample_particles()               # resample particles to focus on areas of high density
-            
+        else:
+            # everything done for the scan from here on, including working out the spread and
+            # publishing the result, is charged to the scheduler's CPU budget
+            start = time.thread_time()
+            stamp = Time.from_msg(msg.header.stamp).nanoseconds*1e-9
+            decision = self.update_scheduler.plan(new_odom_xy_theta, self.current_odom_xy_theta,
+                                                  stamp, self.particle_spread())
+            if decision.deferred:
+                self.get_logger().warn("laser update deferred to stay within the CPU budget "
+                                       "(estimated cost {0:.3f}s)".format(self.update_scheduler.laser_cost),
+                                       throttle_duration_sec=5.0)
+            if decision.propagate:
+                self.update_particles_with_odom()    # update based on odometry
+            if decision.laser:
+                self.update_particles_with_laser(r, theta, (cos_theta, sin_theta))   # update based on laser scan
+                self.update_robot_pose()                # update robot's pose based on particles
+                self.publish_robot_pose(msg.header.stamp)
+                if self.update_scheduler.should_resample(self.weight_distribution):
+                    self.resample_particles()           # resample particles to focus on areas of high density
+            if decision.propagate or decision.laser:
+                # the particles haven't changed otherwise, so there is nothing new to publish
+                self.publish_snapshot(msg.header.stamp)
+                self.publish_particles(msg.header.stamp)
+            self.update_scheduler.record(decision, new_odom_xy_theta, stamp, time.thread_time() - start)
+            return
+
         # publish particles (so things like rviz can see them)
+        self.publish_snapshot(msg.header.stamp)
         self.publish_particles(msg.header.stamp)
 
-    def moved_far_enough_to_update(self, new_odom_xy_theta):
-        return math.fabs(new_odom_xy_theta[0] - self.current_odom_xy_theta[0]) > self.d_thresh or \
-               math.fabs(new_odom_xy_theta[1] - self.current_odom_xy_theta[1]) > self.d_thresh or \
-               math.fabs(new_odom_xy_theta[2] - self.current_odom_xy_theta[2]) > self.a_thresh
+    def particle_spread(self):
+        """ How spread out the particle cloud is: the root of the summed variance of the particles' x and y """
+        if not self.particle_cloud:
+            return float('inf')
+        xs = np.array([p.x for p in self.particle_cloud])
+        ys = np.array([p.y for p in self.particle_cloud])
+        return math.sqrt(xs.var() + ys.var())
 
     def initialize_particle_cloud(self, timestamp, xy_theta=None):
         """ Initialize the particle cloud.
@@ -272,82 +372,115 @@ class ParticleFilter(Node):
             particle.theta += new_theta_2
 
 
-    def update_particles_with_laser(self, r, theta):
-        """ Updates the particle weights in response to the scan data
+    def update_particles_with_laser(self, r, theta, beam_trig=None):
+        """ Updates the particle weights in response to the scan data.  The likelihood of
+            the scan is multiplied into each particle's weight, so the evidence of scans that
+            are not followed by a resample carries over to the next update, and the weights
+            are then normalized.
             r: the distance readings to obstacles
             theta: the angle relative to the robot frame for each corresponding reading 
+            beam_trig: optional precomputed (cos(theta), sin(theta)) arrays
         """
-        # clear weight array
-        self.weight_distribution = []
-        
+        likelihoods = []
+
+        r = np.asarray(r, dtype=float)
+        if beam_trig is None:
+            beam_trig = (np.cos(theta), np.sin(theta))
+        (cos_theta, sin_theta) = beam_trig
+        # catch nan and infinite float values
+        valid = np.isfinite(r)
+        # each beam's endpoint in the robot frame, so only the particle's heading is left to apply
+        x_robot = r[valid]*cos_theta[valid]
+        y_robot = r[valid]*sin_theta[valid]
+
+        # scores are only shared within this scan, so the cache and its counts start empty every time
+        scoring_cache = {} if self.use_scoring_cache else None
+        self.scoring_cache_lookups = 0
+        self.scoring_cache_hits = 0
         # create scan readings for each particle
         for particle in self.particle_cloud:
-            particle.w = 0.0
-            # evaluate each scan for the particle
-            for angle in range(len(r)):
-                # catch nan and infinite float values
-                if not (math.isnan(r[angle]) or math.isinf(r[angle])):
-                    
-                    # rotate then translate the scans according to particle pose
-                    x_pos = r[angle] * math.cos(theta[angle] + particle.theta) + particle.x
-                    y_pos = r[angle] * math.sin(theta[angle] + particle.theta) + particle.y
-
-                    # evaluate scan's similarity to real robot's scan
-                    distance = self.occupancy_field.get_closest_obstacle_distance(x_pos, y_pos)
-                    # if object is in the map
-                    if not math.isnan(distance):
-                        if distance == 0.0:
-                            particle.w = particle.w + 1
-            #update weight array
-            self.weight_distribution.append(particle.w)
+            cos_p = math.cos(particle.theta)
+            sin_p = math.sin(particle.theta)
+            if scoring_cache is not None:
+                key = (math.floor(particle.x/self.scoring_cache_xy_resolution),
+                       math.floor(particle.y/self.scoring_cache_xy_resolution),
+                       math.floor(math.atan2(sin_p, cos_p)/self.scoring_cache_theta_resolution))
+                self.scoring_cache_lookups += 1
+                if key in scoring_cache:
+                    self.scoring_cache_hits += 1
+                    likelihoods.append(scoring_cache[key])
+                    continue
+
+            # rotate then translate the scans according to particle pose
+            x_pos = x_robot*cos_p - y_robot*sin_p + particle.x
+            y_pos = x_robot*sin_p + y_robot*cos_p + particle.y
+
+            # evaluate scan's similarity to real robot's scan, beams that land outside
+            # of the map are nan and never count as a hit
+            distance = self.occupancy_field.get_closest_obstacle_distance(x_pos, y_pos)
+            likelihood = float(np.count_nonzero(distance == 0.0))
+            if scoring_cache is not None:
+                scoring_cache[key] = likelihood
+            likelihoods.append(likelihood)
+
+        weights = [particle.w*likelihood for (particle, likelihood) in zip(self.particle_cloud, likelihoods)]
+        if sum(weights) > 0.0:
+            # otherwise no particle matched the scan, so it tells us nothing and the weights stay as they were
+            for (particle, w) in zip(self.particle_cloud, weights):
+                particle.w = w
+        #update weight array
+        self.weight_distribution = [particle.w for particle in self.particle_cloud]
+        self.normalize_particles()
+        for (particle, w) in zip(self.particle_cloud, self.weight_distribution):
+            particle.w = w
+        if scoring_cache is not None:
+            self.get_logger().debug("scoring cache hit rate: {0:.2f} ({1} of {2} particles)".format(
+                self.scoring_cache_hit_rate(), self.scoring_cache_hits, self.scoring_cache_lookups))
+
+    def scoring_cache_hit_rate(self):
+        """ The fraction of particle scores served from the scoring cache during the last laser
+            update (nan if the cache was not used) """
+        if self.scoring_cache_lookups == 0:
+            return float('nan')
+        return self.scoring_cache_hits/self.scoring_cache_lookups
 
     def update_robot_pose(self):
         """ Update the estimate of the robot's pose given the updated particles.
-            There are two logical methods for this:
-                (1): compute the mean pose
-                (2): compute the most likely pose (i.e. the mode of the distribution)
+            The particles are grouped into spatial clusters and the pose is the weighted
+            mean of the cluster with the most weight, so that a multimodal cloud gives a
+            pose at one of its hypotheses rather than halfway between them.  The heading
+            is a circular mean.  robot_pose_covariance is the spread of the whole cloud
+            around that pose, so the other hypotheses show up as a large covariance when
+            the pose is ambiguous, and robot_pose_cluster_share is the fraction of the
+            weight in the chosen cluster.
         """
-        # first make sure that the particle weights are normalized
-        #self.normalize_particles()
-
-
-        # Method 1, mean pose
-        mean_x = sum(self.x_distribution) / self.n_particles
-        mean_y = sum(self.y_distribution) / self.n_particles
-        mean_theta = sum(self.theta_distribution) / self.n_particles
-
-
-        # Method 2, most likely pose
-        #best_particle = mode(self.particle_cloud)
-        # print(best_particle)
-        # highest_weight = mode(self.particle_cloud)
-        # index = self.weight_distribution.index(highest_weight)
-        # best_particle = self.particle_cloud[index]
-        #pose = self.xy_theta_to_pose(best_particle.x, best_particle.y, best_particle.theta)
-    
-        # a little hard coding to make the robot's pose a bit better
-        if  0 < mean_theta < math.pi/2:
-            extra_x = -0.1
-            extra_y = -0.1
-        elif math.pi/2 < mean_theta < math.pi:
-            extra_x = 0.1
-            extra_y = -0.1
-        elif math.pi < mean_theta < 3*math.pi/2:
-            extra_x = 0.1
-            extra_y = 0.1
-        elif 3*math.pi/2 < mean_theta < 2*math.pi:
-            extra_x = -0.1
-            extra_y = 0.1
-        else:
-            extra_x = 0.0
-            extra_y = 0.0
-        pose = self.xy_theta_to_pose(mean_x + extra_x, mean_y + extra_y, mean_theta)
-
-
-        
-
-        # just to get started we will fix the robot's pose to always be at the origin
-        self.robot_pose = pose
+        xs = np.array([p.x for p in self.particle_cloud])
+        ys = np.array([p.y for p in self.particle_cloud])
+        thetas = np.array([p.theta for p in self.particle_cloud])
+        weights = np.array([p.w for p in self.particle_cloud], dtype=float)
+        if weights.sum() <= 0.0:
+            # no particle matched the scan, so treat them all as equally likely
+            weights = np.ones(len(weights))
+        weights = weights/weights.sum()
+
+        cluster = dominant_cluster(xs, ys, weights, self.pose_cluster_cell_size)
+        cluster_weights = weights[cluster]
+        self.robot_pose_cluster_share = float(cluster_weights.sum())
+        if self.robot_pose_cluster_share <= 0.0:
+            cluster_weights = np.ones(len(cluster_weights))
+        cluster_weights = cluster_weights/cluster_weights.sum()
+
+        mean_x = np.dot(cluster_weights, xs[cluster])
+        mean_y = np.dot(cluster_weights, ys[cluster])
+        mean_theta = math.atan2(np.dot(cluster_weights, np.sin(thetas[cluster])),
+                                np.dot(cluster_weights, np.cos(thetas[cluster])))
+
+        # deviations of every particle from the pose, with the heading wrapped to [-pi, pi]
+        deviations = np.stack([xs - mean_x,
+                               ys - mean_y,
+                               np.arctan2(np.sin(thetas - mean_theta), np.cos(thetas - mean_theta))], axis=1)
+        self.robot_pose_covariance = np.dot((weights[:, np.newaxis]*deviations).T, deviations)
+        self.robot_pose = self.xy_theta_to_pose(float(mean_x), float(mean_y), mean_theta)
 
         self.transform_helper.fix_map_to_odom_transform(self.robot_pose,
                                                         self.odom_pose)
@@ -366,14 +499,29 @@ class ParticleFilter(Node):
         self.x_distribution = [particle.x for particle in self.particle_cloud]
         self.y_distribution = [particle.y for particle in self.particle_cloud]
         self.theta_distribution = [particle.theta for particle in self.particle_cloud]
-        
+
+        # the resampled cloud already reflects the weights, so every particle starts over equally likely
+        self.weight_distribution = [1.0/len(self.particle_cloud)] * len(self.particle_cloud)
+        for particle in self.particle_cloud:
+            particle.w = self.weight_distribution[0]
 
 
     def update_initial_pose(self, msg):
         """ Callback function to handle re-initializing the particle filter based on a pose estimate.
-            These pose estimates could be generated by another ROS Node or could come from the rviz GUI """
+            These pose estimates could be generated by another ROS Node or could come from the rviz GUI.
+            The cloud is replaced by the filter thread, between updates, in process_initial_pose_requests """
         xy_theta = self.transform_helper.convert_pose_to_xy_and_theta(msg.pose.pose)
-        self.initialize_particle_cloud(msg.header.stamp, xy_theta)
+        self.initial_pose_requests.append((msg.header.stamp, xy_theta))
+
+    def process_initial_pose_requests(self):
+        """ Re-initialize the particle cloud if an initial pose has been received since the last loop """
+        try:
+            (timestamp, xy_theta) = self.initial_pose_requests.popleft()
+        except IndexError:
+            return
+        self.initialize_particle_cloud(timestamp, xy_theta)
+        self.publish_snapshot(timestamp)
+        self.publish_particles(timestamp)
 
     
 
@@ -385,10 +533,89 @@ class ParticleFilter(Node):
         
             
 
+    def publish_snapshot(self, timestamp):
+        """ Copy the current filter state into a new FilterSnapshot and swap it in """
+        particles = tuple((p.x, p.y, p.theta, p.w) for p in self.particle_cloud)
+        odom_xy_theta = tuple(self.current_odom_xy_theta) if self.current_odom_xy_theta else None
+        self.snapshot = FilterSnapshot(stamp=timestamp, particles=particles, robot_pose=self.robot_pose,
+                                       odom_xy_theta=odom_xy_theta,
+                                       map_to_odom=self.transform_helper.map_to_odom)
+
+    def current_map_fingerprint(self):
+        """ The fingerprint of the map we are localizing in, recomputed only when the map changes """
+        map_msg = self.occupancy_field.map
+        (cached_map, fingerprint) = self.map_fingerprint_cache
+        if cached_map is not map_msg:
+            fingerprint = map_fingerprint(map_msg)
+            self.map_fingerprint_cache = (map_msg, fingerprint)
+        return fingerprint
+
+    def save_checkpoint(self):
+        """ Timer callback that writes the latest snapshot to checkpoint_path if it has changed.
+            Everything written comes from the one snapshot, so the particles, odometry pose and
+            map -> odom correction always belong to the same filter update. """
+        snapshot = self.snapshot
+        if (self.checkpoint_path is None or
+            snapshot is None or
+            snapshot is self.last_checkpointed_snapshot or
+            snapshot.odom_xy_theta is None or
+            snapshot.map_to_odom is None or
+            not snapshot.particles):
+            return
+        try:
+            write_checkpoint(self.checkpoint_path, time.time(), self.current_map_fingerprint(),
+                             snapshot.particles, snapshot.odom_xy_theta, snapshot.map_to_odom)
+        except OSError as e:
+            self.get_logger().warn("unable to write checkpoint {0}: {1}".format(self.checkpoint_path, e))
+            return
+        self.last_checkpointed_snapshot = snapshot
+
+    def restore_checkpoint(self):
+        """ Resume from the checkpoint at checkpoint_path if it is recent enough and was
+            written for the map we just loaded.  The odometry pose is restored along with
+            the particles, so motion since the checkpoint is applied at the next update. """
+        if self.checkpoint_path is None:
+            return
+        checkpoint = read_checkpoint(self.checkpoint_path)
+        if checkpoint is None:
+            return
+        age = time.time() - checkpoint.wall_time
+        if age > self.checkpoint_max_age:
+            self.get_logger().info("ignoring checkpoint that is {0:.1f} seconds old".format(age))
+            return
+        if checkpoint.map_fingerprint != self.current_map_fingerprint():
+            self.get_logger().info("ignoring checkpoint written for a different map")
+            return
+        particles = checkpoint.particles
+        self.particle_cloud = [Particle(x, y, theta, w) for (x, y, theta, w) in particles.tolist()]
+        self.x_distribution = particles['x'].tolist()
+        self.y_distribution = particles['y'].tolist()
+        self.theta_distribution = particles['theta'].tolist()
+        self.weight_distribution = particles['w'].tolist()
+        self.current_odom_xy_theta = checkpoint.odom_xy_theta
+        self.transform_helper.map_to_odom = checkpoint.map_to_odom
+        self.get_logger().info("resumed {0} particles from a checkpoint {1:.1f} seconds old".format(len(self.particle_cloud), age))
+
+    def publish_robot_pose(self, timestamp):
+        """ Publish the robot pose with its covariance so that, e.g., planners can tell when
+            localization is ambiguous.  The covariance includes the particles outside of the
+            cluster the pose was taken from (see update_robot_pose), so a cloud split between
+            several hypotheses is reported as uncertain even if each hypothesis is tight. """
+        msg = PoseWithCovarianceStamped(header=Header(stamp=timestamp, frame_id=self.map_frame))
+        msg.pose.pose = self.robot_pose
+        # the covariance is row major over (x, y, z, roll, pitch, yaw); we only estimate x, y and yaw
+        covariance = np.zeros((6, 6))
+        covariance[np.ix_([0, 1, 5], [0, 1, 5])] = self.robot_pose_covariance
+        msg.pose.covariance = covariance.ravel().tolist()
+        self.pose_pub.publish(msg)
+
     def publish_particles(self, timestamp):
+        snapshot = self.snapshot
+        if snapshot is None:
+            return
         particles_conv = []
-        for p in self.particle_cloud:
-            particles_conv.append(p.as_pose())
+        for (x, y, theta, w) in snapshot.particles:
+            particles_conv.append(self.xy_theta_to_pose(x, y, theta))
         # actually send the message so that we can view it in rviz
         self.particle_pub.publish(PoseArray(header=Header(stamp=timestamp,
                                             frame_id=self.map_frame),
@@ -399,7 +626,8 @@ class ParticleFilter(Node):
         self.last_scan_timestamp = msg.header.stamp
         # we throw away scans until we are done processing the previous scan
         # self.scan_to_process is set to None in the run_loop 
-        if self.scan_to_process is None:
+        # until the map is ready nothing is being processed, so just keep the latest scan
+        if self.scan_to_process is None or not self.occupancy_field.ready.is_set():
             self.scan_to_process = msg
 
     def xy_theta_to_pose(self, x, y, theta):
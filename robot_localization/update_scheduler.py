@@ -0,0 +1,157 @@
+""" Decides when the particle filter should propagate its particles with odometry,
+    weight them with a laser scan and resample them, in place of fixed motion thresholds """
+
+import math
+import time
+from collections import deque, namedtuple
+
+# What the filter should do with the current scan
+#   propagate: move the particles using the odometry since the last propagation
+#   laser: weight the particles with the scan (and update the robot pose)
+#   deferred: a laser update was due but held back to stay within the CPU budget
+UpdateDecision = namedtuple('UpdateDecision', ['propagate', 'laser', 'deferred'])
+
+def angle_normalize(z):
+    """ convenience function to map an angle to the range [-pi,pi] """
+    return math.atan2(math.sin(z), math.cos(z))
+
+class UpdateScheduler(object):
+    """ Schedules filter updates based on how far the robot has moved, how long it has
+        been since the last laser update, how spread out the particles are and how
+        degenerate the weights are, while keeping the filter within a CPU budget.
+
+        A laser update is due once the robot has moved d_thresh (or turned a_thresh)
+        since the last one.  Those thresholds are stretched by up to max_threshold_scale
+        when the cloud is tighter than confident_spread and shrunk by down to
+        min_threshold_scale when it is wider.  A laser update is also due after
+        max_laser_interval seconds if the robot has moved at all or the cloud is wide.
+        Odometry is propagated on its own when the robot has moved d_thresh / a_thresh
+        but the laser update is deferred.
+
+        The CPU budget covers all of the filter's work on each scan once it is running,
+        i.e. everything the caller passes to record, including scans where no update was
+        made.  It is a soft limit: an update is only started if the CPU time used in the
+        last second plus a running estimate of that update's cost fits in the budget, so
+        an update that costs more than its estimate can overrun it.  An update is always
+        started if there has been none in the last second, so updates that cost more than
+        the whole budget slow the filter down to about one per second instead of stopping
+        it.  The window is measured with clock, which defaults to wall-clock time.
+
+        Attributes:
+            d_thresh: the nominal amount of linear movement between laser updates (meters)
+            a_thresh: the nominal amount of angular movement between laser updates (radians)
+            confident_spread: the particle spread (meters) at which the nominal thresholds apply
+            min_threshold_scale / max_threshold_scale: the range the thresholds are scaled over
+            max_laser_interval: the longest time (seconds of scan time) between laser updates
+            resample_ess_ratio: resample when the effective sample size drops below this
+                                fraction of the number of particles
+            cpu_budget: the CPU time (seconds) the filter may use in any one second window
+                        (None disables the budget, e.g. for deterministic bag replays)
+            clock: returns the current time (seconds) that the budget window is measured in
+            laser_cost: a running estimate of the CPU time of one laser update
+            propagate_cost: a running estimate of the CPU time of an odometry-only propagation
+            recent_costs: (clock time, cpu time) of the scans handled in the current window
+            last_update_time: the clock time of the last propagation or laser update
+    """
+
+    def __init__(self, d_thresh, a_thresh, confident_spread=0.2,
+                 min_threshold_scale=0.5, max_threshold_scale=2.0,
+                 max_laser_interval=2.0, resample_ess_ratio=0.9, cpu_budget=0.5,
+                 clock=time.monotonic):
+        self.d_thresh = d_thresh
+        self.a_thresh = a_thresh
+        self.confident_spread = confident_spread
+        self.min_threshold_scale = min_threshold_scale
+        self.max_threshold_scale = max_threshold_scale
+        self.max_laser_interval = max_laser_interval
+        self.resample_ess_ratio = resample_ess_ratio
+        self.cpu_budget = cpu_budget
+        self.clock = clock
+        self.laser_cost = 0.0
+        self.propagate_cost = 0.0
+        self.recent_costs = deque()
+        self.last_update_time = None
+        self.laser_odom_xy_theta = None         # odometry pose at the last laser update
+        self.laser_stamp = None                 # scan time (seconds) of the last laser update
+
+    @staticmethod
+    def motion(from_xy_theta, to_xy_theta):
+        """ The distance travelled and the absolute change in heading between two poses """
+        return (math.hypot(to_xy_theta[0] - from_xy_theta[0], to_xy_theta[1] - from_xy_theta[1]),
+                math.fabs(angle_normalize(to_xy_theta[2] - from_xy_theta[2])))
+
+    def cpu_used(self, now):
+        """ The CPU time spent handling scans in the last second """
+        while self.recent_costs and self.recent_costs[0][0] <= now - 1.0:
+            self.recent_costs.popleft()
+        return sum(cost for (t, cost) in self.recent_costs)
+
+    def within_budget(self, cost):
+        """ Whether an update estimated to take cost seconds of CPU time fits in the budget """
+        if self.cpu_budget is None:
+            return True
+        now = self.clock()
+        if self.last_update_time is None or now - self.last_update_time >= 1.0:
+            return True
+        return self.cpu_used(now) + cost <= self.cpu_budget
+
+    @staticmethod
+    def running_estimate(estimate, cost):
+        """ Fold cost into a running estimate, exponentially weighted so that the estimate
+            follows changes in the number of particles """
+        return cost if estimate == 0.0 else 0.8*estimate + 0.2*cost
+
+    def plan(self, odom_xy_theta, propagated_odom_xy_theta, stamp, spread):
+        """ Decide what to do with a scan
+            odom_xy_theta: the odometry pose matching the scan
+            propagated_odom_xy_theta: the odometry pose the particles were last propagated to
+            stamp: the scan time in seconds
+            spread: how spread out the particles are (meters), see ParticleFilter.particle_spread
+
+            returns: an UpdateDecision """
+        if self.laser_odom_xy_theta is None:
+            # measure motion and time from the particles' current odometry pose
+            self.laser_odom_xy_theta = propagated_odom_xy_theta
+            self.laser_stamp = stamp
+        (laser_d, laser_a) = self.motion(self.laser_odom_xy_theta, odom_xy_theta)
+        (propagate_d, propagate_a) = self.motion(propagated_odom_xy_theta, odom_xy_theta)
+
+        if spread > 0.0:
+            scale = min(max(self.confident_spread/spread, self.min_threshold_scale), self.max_threshold_scale)
+        else:
+            scale = self.max_threshold_scale
+        moved_far = laser_d > self.d_thresh*scale or laser_a > self.a_thresh*scale
+        overdue = (stamp - self.laser_stamp > self.max_laser_interval and
+                   (laser_d > 0.0 or laser_a > 0.0 or spread > self.confident_spread))
+        # anything deferred here is picked up later, since motion keeps accumulating.
+        # laser_cost covers the propagation that comes with a laser update.
+        due = moved_far or overdue
+        laser = due and self.within_budget(self.laser_cost)
+        propagate = ((laser and (propagate_d > 0.0 or propagate_a > 0.0)) or
+                     ((propagate_d > self.d_thresh or propagate_a > self.a_thresh) and
+                      self.within_budget(self.propagate_cost)))
+        return UpdateDecision(propagate=propagate, laser=laser, deferred=due and not laser)
+
+    def record(self, decision, odom_xy_theta, stamp, cost):
+        """ Note that decision was carried out for the scan at odom_xy_theta / stamp using
+            cost seconds of CPU time.  cost should cover all of the work done for the scan,
+            even if neither update was made. """
+        if decision.laser:
+            self.laser_odom_xy_theta = odom_xy_theta
+            self.laser_stamp = stamp
+            self.laser_cost = self.running_estimate(self.laser_cost, cost)
+        elif decision.propagate:
+            self.propagate_cost = self.running_estimate(self.propagate_cost, cost)
+        now = self.clock()
+        if decision.propagate or decision.laser:
+            self.last_update_time = now
+        self.recent_costs.append((now, cost))
+
+    def should_resample(self, weights):
+        """ Whether the (unnormalized) weights are degenerate enough to resample.  If every
+            weight is zero the scan told us nothing, so the particles are left alone. """
+        total = sum(weights)
+        if total <= 0.0:
+            return False
+        effective_sample_size = 1.0/sum((w/total)**2 for w in weights)
+        return effective_sample_size < self.resample_ess_ratio*len(weights)
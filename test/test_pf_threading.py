@@ -0,0 +1,238 @@
+""" Stress test for the hand-off of filter state between the filter thread and the
+    rclpy callbacks / timers.  The filter runs run_loop on one thread while other
+    threads keep sending initial poses and scans and reading the published state.
+
+    TF and the occupancy field are replaced by small fakes, and when the ROS Python
+    packages are not installed they are replaced by stand-ins as well, so the test
+    only exercises the threading in pf.py. """
+
+import importlib
+import math
+import os
+import sys
+import time
+from threading import Event, Thread
+from types import ModuleType, SimpleNamespace
+
+import numpy as np
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PACKAGE_DIR, 'robot_localization'))
+sys.path.insert(0, PACKAGE_DIR)
+
+def _message(name, **defaults):
+    """ A stand-in for a ROS message class that accepts any fields as keyword arguments """
+    def __init__(self, **kwargs):
+        for (field, factory) in defaults.items():
+            setattr(self, field, factory())
+        self.__dict__.update(kwargs)
+    return type(name, (object,), {'__init__': __init__})
+
+class _Publisher(object):
+    def publish(self, msg):
+        pass
+
+class _Logger(object):
+    def info(self, *args, **kwargs):
+        pass
+    warn = error = debug = info
+
+class _Node(object):
+    def __init__(self, name):
+        self._logger = _Logger()
+    def create_subscription(self, *args, **kwargs):
+        return None
+    def create_publisher(self, *args, **kwargs):
+        return _Publisher()
+    def create_timer(self, *args, **kwargs):
+        return None
+    def create_client(self, *args, **kwargs):
+        return None
+    def get_logger(self):
+        return self._logger
+    def destroy_node(self):
+        pass
+
+class _Time(object):
+    def __init__(self, nanoseconds=0):
+        self.nanoseconds = nanoseconds
+    @classmethod
+    def from_msg(cls, msg):
+        return cls(msg.sec*10**9 + msg.nanosec)
+
+class _Duration(object):
+    def __init__(self, seconds=0.0):
+        self.seconds = seconds
+
+def _stub_module(name, **attributes):
+    """ Register a stand-in module (and its parents) unless the real one can be imported """
+    try:
+        importlib.import_module(name)
+        return
+    except ImportError:
+        pass
+    parts = name.split('.')
+    for i in range(1, len(parts) + 1):
+        sys.modules.setdefault('.'.join(parts[:i]), ModuleType('.'.join(parts[:i])))
+    sys.modules[name].__dict__.update(attributes)
+
+Header = _message('Header')
+_stub_module('rclpy', init=lambda *args, **kwargs: None, shutdown=lambda *args, **kwargs: None)
+_stub_module('rclpy.node', Node=_Node)
+_stub_module('rclpy.time', Time=_Time)
+_stub_module('rclpy.duration', Duration=_Duration)
+_stub_module('rclpy.qos', qos_profile_sensor_data=None, QoSProfile=_message('QoSProfile'),
+             DurabilityPolicy=SimpleNamespace(TRANSIENT_LOCAL=1),
+             ReliabilityPolicy=SimpleNamespace(RELIABLE=1))
+_stub_module('builtin_interfaces.msg', Time=_message('Time'))
+_stub_module('std_msgs.msg', Header=Header, String=_message('String'))
+_stub_module('sensor_msgs.msg', LaserScan=_message('LaserScan'))
+_stub_module('geometry_msgs.msg',
+             PoseWithCovarianceStamped=_message('PoseWithCovarianceStamped', header=Header,
+                                                pose=lambda: SimpleNamespace(pose=None, covariance=None)),
+             PoseArray=_message('PoseArray'), Pose=_message('Pose'), Point=_message('Point'),
+             Quaternion=_message('Quaternion'), PoseStamped=_message('PoseStamped'),
+             TransformStamped=_message('TransformStamped'))
+_stub_module('nav_msgs.srv', GetMap=_message('GetMap'))
+_stub_module('nav_msgs.msg', OccupancyGrid=_message('OccupancyGrid'))
+_stub_module('map_msgs.msg', OccupancyGridUpdate=_message('OccupancyGridUpdate'))
+_stub_module('tf2_ros.buffer', Buffer=object)
+_stub_module('tf2_ros.transform_listener', TransformListener=object)
+_stub_module('tf2_ros.transform_broadcaster', TransformBroadcaster=object)
+_stub_module('tf2_msgs.msg', TFMessage=_message('TFMessage'))
+_stub_module('PyKDL')
+
+import rclpy
+from builtin_interfaces.msg import Time as StampMsg
+import pf
+
+N_PARTICLES = 100
+
+class FakeOccupancyField(object):
+    """ A map where roughly a third of the world is an obstacle, in a fixed pattern """
+    def __init__(self, node, map_msg=None, status_callback=None):
+        self.map = map_msg
+        self.ready = Event()
+        self.ready.set()
+
+    def get_obstacle_bounding_box(self):
+        return ((-10.0, 10.0), (-10.0, 10.0))
+
+    def get_closest_obstacle_distance(self, x, y):
+        return np.where((np.floor(x*4) + np.floor(y*4)) % 3 == 0, 0.0, 1.0)
+
+class FakeTFHelper(object):
+    """ Odometry that drives forward a little on every scan.  Every map -> odom correction is
+        remembered along with the robot pose it was computed from so that snapshots can be
+        checked for mismatched pairs. """
+    def __init__(self, node):
+        self.map_to_odom = None
+        self.odom_x = 0.0
+        self.corrections = {}
+        theta = np.linspace(-math.pi, math.pi, 36)
+        self.beam_table = (theta, np.cos(theta), np.sin(theta))
+
+    def get_matching_odom_pose(self, odom_frame, base_frame, timestamp):
+        self.odom_x += 0.05
+        return (SimpleNamespace(x=self.odom_x, y=0.0, theta=0.0), 0.0)
+
+    def convert_pose_to_xy_and_theta(self, pose):
+        if hasattr(pose, 'theta'):
+            return (pose.x, pose.y, pose.theta)
+        return (pose.position.x, pose.position.y, 2*math.atan2(pose.orientation.z, pose.orientation.w))
+
+    def get_beam_table(self, msg, base_frame):
+        return self.beam_table
+
+    def fix_map_to_odom_transform(self, robot_pose, odom_pose):
+        (x, y, theta) = self.convert_pose_to_xy_and_theta(robot_pose)
+        map_to_odom = ((x - odom_pose.x, y - odom_pose.y, 0.0), (0.0, 0.0, 0.0, 1.0))
+        self.corrections[id(robot_pose)] = (robot_pose, map_to_odom)
+        self.map_to_odom = map_to_odom
+
+def make_filter(monkeypatch):
+    monkeypatch.setattr(pf, 'OccupancyField', FakeOccupancyField)
+    monkeypatch.setattr(pf, 'TFHelper', FakeTFHelper)
+    particle_filter = pf.ParticleFilter(map_msg=SimpleNamespace(), run_thread=False)
+    particle_filter.checkpoint_path = None
+    particle_filter.n_particles = N_PARTICLES
+    return particle_filter
+
+def stamp(i):
+    return StampMsg(sec=i//10, nanosec=(i % 10)*100000000)
+
+def check_snapshot(particle_filter, snapshot):
+    assert len(snapshot.particles) == N_PARTICLES
+    for particle in snapshot.particles:
+        assert len(particle) == 4
+        assert all(math.isfinite(value) for value in particle)
+    if snapshot.robot_pose is not None:
+        # the correction must be the one computed from this very robot pose
+        (robot_pose, map_to_odom) = particle_filter.transform_helper.corrections[id(snapshot.robot_pose)]
+        assert robot_pose is snapshot.robot_pose
+        assert snapshot.map_to_odom == map_to_odom
+
+def test_callbacks_during_updates(monkeypatch):
+    # switch threads far more often than usual so that races show up within the test's run time
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-5)
+    rclpy.init()
+    try:
+        particle_filter = make_filter(monkeypatch)
+        stop = Event()
+        errors = []
+        counts = {'snapshots': 0, 'localized': 0}
+
+        def hammer(target):
+            def run():
+                i = 0
+                try:
+                    while not stop.is_set():
+                        target(i)
+                        i += 1
+                except Exception as e:
+                    errors.append(e)
+                    stop.set()
+            return Thread(target=run)
+
+        def filter_step(i):
+            particle_filter.run_loop()
+
+        def send_initial_pose(i):
+            rng = np.random.default_rng(i)
+            pose = particle_filter.xy_theta_to_pose(float(rng.uniform(-2, 2)), float(rng.uniform(-2, 2)),
+                                                    float(rng.uniform(-math.pi, math.pi)))
+            particle_filter.update_initial_pose(SimpleNamespace(header=SimpleNamespace(stamp=stamp(i)),
+                                                                pose=SimpleNamespace(pose=pose)))
+
+        def send_scan(i):
+            particle_filter.scan_received(SimpleNamespace(header=SimpleNamespace(stamp=stamp(i)),
+                                                          ranges=[1.0 + 0.01*(i % 50)]*36))
+
+        def read_state(i):
+            snapshot = particle_filter.snapshot
+            if snapshot is not None:
+                check_snapshot(particle_filter, snapshot)
+                counts['snapshots'] += 1
+                if snapshot.robot_pose is not None:
+                    counts['localized'] += 1
+            map_to_odom = particle_filter.transform_helper.map_to_odom
+            if map_to_odom is not None:
+                (translation, rotation) = map_to_odom
+                assert len(translation) == 3 and len(rotation) == 4
+
+        threads = [hammer(step) for step in (filter_step, send_initial_pose, send_scan, read_state, read_state)]
+        for thread in threads:
+            thread.start()
+        time.sleep(2.0)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        assert counts['snapshots'] > 0
+        assert counts['localized'] > 0
+        check_snapshot(particle_filter, particle_filter.snapshot)
+    finally:
+        rclpy.shutdown()
+        sys.setswitchinterval(switch_interval)
@@ -0,0 +1,41 @@
+""" Tests for the pose estimate and covariance computed from the particle cloud.  This
+    reuses the stand-ins for ROS and the fake TF / occupancy field of the threading test. """
+
+import math
+from types import SimpleNamespace
+
+import numpy as np
+
+# importing the threading test first puts the ROS stand-ins in place when ROS is not installed
+from test_pf_threading import N_PARTICLES, make_filter
+import rclpy
+import pf
+
+def pose_estimate(monkeypatch, centers):
+    """ Run update_robot_pose on a cloud split evenly between tight clusters at centers """
+    rclpy.init()
+    try:
+        particle_filter = make_filter(monkeypatch)
+        rng = np.random.default_rng(0)
+        particle_filter.odom_pose = SimpleNamespace(x=0.0, y=0.0, theta=0.0)
+        particle_filter.particle_cloud = [pf.Particle(float(x + rng.normal(0, 0.02)),
+                                                      float(y + rng.normal(0, 0.02)),
+                                                      float(rng.normal(0, 0.01)), 1.0)
+                                          for i in range(N_PARTICLES)
+                                          for (x, y) in [centers[i % len(centers)]]]
+        particle_filter.update_robot_pose()
+        return particle_filter
+    finally:
+        rclpy.shutdown()
+
+def test_bimodal_cloud_is_more_uncertain(monkeypatch):
+    unimodal = pose_estimate(monkeypatch, [(0.0, 0.0)])
+    bimodal = pose_estimate(monkeypatch, [(0.0, 0.0), (3.0, 0.0)])
+
+    assert math.isclose(unimodal.robot_pose_cluster_share, 1.0)
+    assert math.isclose(bimodal.robot_pose_cluster_share, 0.5)
+    # the pose is at one of the hypotheses, not halfway between them
+    assert (abs(bimodal.robot_pose.position.x) < 0.1 or
+            abs(bimodal.robot_pose.position.x - 3.0) < 0.1)
+    # the other hypothesis makes the reported position much more uncertain
+    assert np.trace(bimodal.robot_pose_covariance[:2, :2]) > 100*np.trace(unimodal.robot_pose_covariance[:2, :2])
@@ -0,0 +1,85 @@
+""" Tests for the CPU budget of the update scheduler.  The budget window is driven by a
+    fake clock so that the tests do not depend on how long anything actually takes. """
+
+import os
+import sys
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PACKAGE_DIR, 'robot_localization'))
+
+from update_scheduler import UpdateScheduler
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+    def __call__(self):
+        return self.now
+
+def make_scheduler(cpu_budget=0.5):
+    clock = FakeClock()
+    return (UpdateScheduler(0.2, 0.5, cpu_budget=cpu_budget, clock=clock), clock)
+
+def test_laser_update_deferred_while_budget_is_used():
+    (scheduler, clock) = make_scheduler()
+    decision = scheduler.plan((1.0, 0.0, 0.0), (0.0, 0.0, 0.0), 0.0, 0.1)
+    assert decision.laser and not decision.deferred
+    scheduler.record(decision, (1.0, 0.0, 0.0), 0.0, 0.3)
+
+    clock.now = 0.1
+    decision = scheduler.plan((2.0, 0.0, 0.0), (1.0, 0.0, 0.0), 0.1, 0.1)
+    assert not decision.laser and decision.deferred
+
+    clock.now = 1.5
+    decision = scheduler.plan((2.0, 0.0, 0.0), (1.0, 0.0, 0.0), 1.5, 0.1)
+    assert decision.laser and not decision.deferred
+
+def test_update_costing_more_than_budget_does_not_stop_updates():
+    (scheduler, clock) = make_scheduler()
+    decision = scheduler.plan((1.0, 0.0, 0.0), (0.0, 0.0, 0.0), 0.0, 0.1)
+    scheduler.record(decision, (1.0, 0.0, 0.0), 0.0, 0.6)
+    assert scheduler.laser_cost > scheduler.cpu_budget
+
+    odom = (1.0, 0.0, 0.0)
+    for t in (10.0, 20.0, 30.0, 40.0, 50.0):
+        clock.now = t
+        new_odom = (odom[0] + 1.0, 0.0, 0.0)
+        decision = scheduler.plan(new_odom, odom, t, 5.0)
+        assert decision.laser and decision.propagate
+        scheduler.record(decision, new_odom, t, 0.6)
+        odom = new_odom
+
+def test_propagation_costing_more_than_budget_does_not_stop_propagation():
+    (scheduler, clock) = make_scheduler()
+    scheduler.propagate_cost = 0.6
+    # the robot has moved past d_thresh but not far enough for a laser update
+    scheduler.laser_odom_xy_theta = (0.0, 0.0, 0.0)
+    scheduler.laser_stamp = 0.0
+    decision = scheduler.plan((0.3, 0.0, 0.0), (0.0, 0.0, 0.0), 0.1, 0.1)
+    assert decision.propagate and not decision.laser
+
+def test_no_budget():
+    (scheduler, clock) = make_scheduler(cpu_budget=None)
+    odom = (0.0, 0.0, 0.0)
+    for i in range(10):
+        new_odom = (odom[0] + 1.0, 0.0, 0.0)
+        decision = scheduler.plan(new_odom, odom, i*0.1, 0.1)
+        assert decision.laser
+        scheduler.record(decision, new_odom, i*0.1, 10.0)
+        odom = new_odom
+
+def test_scans_without_updates_count_against_budget():
+    (scheduler, clock) = make_scheduler()
+    scheduler.laser_cost = 0.1
+    # scans where the robot hasn't moved still cost something, e.g. working out the spread
+    for i in range(5):
+        clock.now = i*0.1
+        decision = scheduler.plan((0.0, 0.0, 0.0), (0.0, 0.0, 0.0), i*0.1, 0.1)
+        assert not decision.laser and not decision.propagate
+        scheduler.record(decision, (0.0, 0.0, 0.0), i*0.1, 0.1)
+    decision = scheduler.plan((1.0, 0.0, 0.0), (0.0, 0.0, 0.0), 0.5, 0.1)
+    assert decision.laser
+    scheduler.record(decision, (1.0, 0.0, 0.0), 0.5, 0.1)
+
+    clock.now = 0.6
+    decision = scheduler.plan((2.0, 0.0, 0.0), (1.0, 0.0, 0.0), 0.6, 0.1)
+    assert not decision.laser and decision.deferred